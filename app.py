@@ -1,14 +1,22 @@
 import os
+import re
 import time
-import json
+import functools
+import hmac
+import sqlite3
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Set
 from urllib.parse import urlparse, quote
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from flask import Flask, request
+from flask.json.provider import JSONProvider
+from markupsafe import escape
 
 # грузим .env
 load_dotenv()
@@ -20,17 +28,46 @@ if not TELEGRAM_BOT_TOKEN:
 GITLAB_BASE_URL = os.getenv("GITLAB_BASE_URL", "https://gitlab.com")
 
 TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+TELEGRAM_SEND_MESSAGE_URL = f"{TELEGRAM_API}/sendMessage"
+TELEGRAM_SEND_STICKER_URL = f"{TELEGRAM_API}/sendSticker"
+TELEGRAM_GET_UPDATES_URL = f"{TELEGRAM_API}/getUpdates"
+
+GITLAB_USER_LOOKUP_URL = f'{GITLAB_BASE_URL.rstrip("/")}/api/v4/users?username=USERNAME'
 
 GITLAB_WEBHOOK_SECRET = os.getenv("GITLAB_WEBHOOK_SECRET")
+
+# если задан публичный URL — Telegram сам шлёт апдейты на /telegram/webhook/<secret>,
+# иначе (например, за NAT) работаем через long polling
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+if TELEGRAM_WEBHOOK_URL:
+    if not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("В .env не задан TELEGRAM_WEBHOOK_SECRET (нужен при TELEGRAM_WEBHOOK_URL)")
+    # ограничения Telegram: иначе setWebhook отвечает 400 на каждой попытке
+    if not TELEGRAM_WEBHOOK_URL.startswith("https://"):
+        raise RuntimeError("TELEGRAM_WEBHOOK_URL должен начинаться с https://")
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", TELEGRAM_WEBHOOK_SECRET):
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET: только A-Z, a-z, 0-9, _ и -, не длиннее 256 символов")
+
 FLASK_PORT = int(os.getenv("PORT", "3000"))
 
 # токен для GitLab API (нужен read_api на одобрения)
 GITLAB_API_TOKEN = os.getenv("GITLAB_API_TOKEN")
 GITLAB_API_TOKEN_TYPE = os.getenv("GITLAB_API_TOKEN_TYPE", "private").lower()  # "private" | "bearer"
+# "auto": API только если счётчик из payload выглядит устаревшим, "always": всегда спрашивать API
+GITLAB_APPROVALS_API = os.getenv("GITLAB_APPROVALS_API", "auto").lower()
+if not GITLAB_API_TOKEN:
+    GITLAB_AUTH_HEADERS: dict[str, str] = {}
+elif GITLAB_API_TOKEN_TYPE == "bearer":
+    GITLAB_AUTH_HEADERS = {"Authorization": f"Bearer {GITLAB_API_TOKEN}"}
+else:
+    GITLAB_AUTH_HEADERS = {"PRIVATE-TOKEN": GITLAB_API_TOKEN}
 
 # файлы состояния
 BASE_DIR = Path(__file__).parent
-SUBSCRIPTIONS_FILE = BASE_DIR / "subscriptions.json"   # chat_id -> gitlab_id
+SUBSCRIPTIONS_DB_FILE = BASE_DIR / "subscriptions.db"  # таблица subs: chat_id -> gitlab_id
+# прежний формат подписок (chat_id -> gitlab_id), импортируется в БД при первом запуске
+SUBSCRIPTIONS_FILE = BASE_DIR / "subscriptions.json"
 MR_REVIEWERS_FILE = BASE_DIR / "mr_reviewers.json"     # "<project_id>:<iid>" -> [reviewer_id, ...]
 
 # стикеры
@@ -38,26 +75,127 @@ STICKER_APPROVED   = os.getenv("STICKER_APPROVED",   "CAACAgIAAxkBAAET_XxpG3JHVU
 STICKER_MERGE_OK   = os.getenv("STICKER_MERGE_OK",   "CAACAgIAAxkBAAET_GZpGzi5Yf6w2obp5JQ_Bwhdbs1zTgACGQAD7CAzGfgftAqnaujQNgQ")
 STICKER_UNAPPROVAL = os.getenv("STICKER_UNAPPROVAL", "CAACAgIAAxkBAAET_H5pGz2J6GfHPuKogykmDg2K9kDtKwACEwAD7CAzGarT2GEZWCDhNgQ")
 
-app = Flask(__name__)
+class OrjsonProvider(JSONProvider):
+    # orjson заметно быстрее stdlib json на payload'ах вебхуков GitLab
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class App(Flask):
+    json_provider_class = OrjsonProvider
+
+app = App(__name__)
+
+# ================== HTTP-СЕССИИ ==================
+
+def _make_session() -> requests.Session:
+    # keep-alive + пул соединений urllib3, чтобы не делать TLS-хендшейк на каждый запрос
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "gitlab-notifications-tg-bot"
+    return session
+
+# api.telegram.org
+SESSION = _make_session()
+
+# GitLab API, заголовок авторизации выставляется один раз
+GITLAB_SESSION = _make_session()
+GITLAB_SESSION.headers.update(GITLAB_AUTH_HEADERS)
+
+def prewarm_connections() -> None:
+    # открываем TLS-соединения заранее, чтобы первый вебхук не платил за хендшейк
+    targets = [(SESSION, f"{TELEGRAM_API}/getMe")]
+    if GITLAB_API_TOKEN:
+        targets.append((GITLAB_SESSION, f'{GITLAB_BASE_URL.rstrip("/")}/api/v4/version'))
+    for session, url in targets:
+        try:
+            session.get(url, timeout=5)
+        except Exception as e:
+            print("prewarm error:", e)
 
 # ================== ПЕРСИСТЕНТНОЕ СОСТОЯНИЕ ==================
 
 def _load_json(path: Path, default):
     if path.exists():
         try:
-            return json.loads(path.read_text("utf-8"))
+            return orjson.loads(path.read_bytes())
         except Exception as e:
             print(f"load error for {path.name}:", e)
     return default
 
-def _save_json(path: Path, data) -> None:
+# path -> хэш последнего записанного содержимого, чтобы не переписывать файл без изменений
+_last_saved_hash: dict[Path, int] = {}
+
+# gunicorn (gthread) обрабатывает вебхуки в нескольких потоках, запись файлов сериализуем
+_save_lock = threading.Lock()
+
+def _save_json(path: Path, data) -> bool:
+    # False, если файл не записан: вызывающий не должен делать ничего необратимого после неудачной записи
     try:
-        path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+        content = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        content_hash = hash(content)
+        with _save_lock:
+            if _last_saved_hash.get(path) == content_hash:
+                return True
+            # пишем во временный файл и атомарно подменяем, чтобы при падении не получить битый JSON
+            tmp_path = path.with_suffix(path.suffix + ".tmp")
+            tmp_path.write_bytes(content)
+            os.replace(tmp_path, path)
+            _last_saved_hash[path] = content_hash
+        return True
     except Exception as e:
         print(f"save error for {path.name}:", e)
+        return False
+
+def _load_legacy_subscriptions() -> dict[int, int]:
+    result: dict[int, int] = {}
+    for chat_id, gitlab_id in _load_json(SUBSCRIPTIONS_FILE, {}).items():
+        try:
+            result[int(chat_id)] = int(gitlab_id)
+        except Exception:
+            continue
+    return result
+
+# подписки в SQLite (WAL): поллер пишет, веб-процесс читает, без гонок и перезаписи файла целиком.
+# соединение на поток — sqlite3.Connection нельзя безопасно делить между потоками
+_db_local = threading.local()
+
+def _db() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SUBSCRIPTIONS_DB_FILE, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
+def _init_subscriptions_db() -> None:
+    conn = _db()
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS subs (chat_id INTEGER PRIMARY KEY, gitlab_id INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subs_gitlab ON subs(gitlab_id)")
+
+    if conn.execute("SELECT 1 FROM subs LIMIT 1").fetchone() is not None:
+        return
+    legacy = _load_legacy_subscriptions()
+    if legacy:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO subs (chat_id, gitlab_id) VALUES (?, ?)", legacy.items())
+        print(f"imported {len(legacy)} subscriptions into {SUBSCRIPTIONS_DB_FILE.name}")
+
+def _subscribe(chat_id: int, gitlab_id: int) -> None:
+    try:
+        conn = _db()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO subs (chat_id, gitlab_id) VALUES (?, ?)", (chat_id, gitlab_id))
+    except Exception as e:
+        print(f"save error for {SUBSCRIPTIONS_DB_FILE.name}:", e)
 
-# chat_id (str) -> gitlab_id (int)
-subscriptions: dict[str, int] = _load_json(SUBSCRIPTIONS_FILE, {})
+_init_subscriptions_db()
 
 # "<project_id>:<iid>" -> list[int]
 _mr_reviewers_store: dict[str, list[int]] = _load_json(MR_REVIEWERS_FILE, {})
@@ -65,6 +203,9 @@ _mr_reviewers_store: dict[str, list[int]] = _load_json(MR_REVIEWERS_FILE, {})
 def _mr_key(project_id: int, iid: int) -> str:
     return f"{int(project_id)}:{int(iid)}"
 
+# сравнение прежнего и текущего состава ревьюеров должно быть атомарным между потоками
+_mr_reviewers_lock = threading.Lock()
+
 def _get_prev_reviewer_set(project_id: int, iid: int) -> Set[int]:
     key = _mr_key(project_id, iid)
     return set(_mr_reviewers_store.get(key, []))
@@ -76,28 +217,31 @@ def _set_current_reviewer_set(project_id: int, iid: int, ids: Set[int]) -> None:
 
 # ================== ТГ УТИЛИТЫ ==================
 
-def send_message(chat_id: int, text: str) -> None:
+# неизменяемая часть тела sendMessage, на каждый вызов только копия с chat_id/text
+SEND_MESSAGE_DEFAULTS = {
+    "parse_mode": "HTML",
+    "disable_web_page_preview": True,
+}
+
+def send_message(chat_id: int, text: str) -> bool:
     try:
-        resp = requests.post(
-            f"{TELEGRAM_API}/sendMessage",
-            json={
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": "HTML",
-                "disable_web_page_preview": True,
-            },
+        resp = SESSION.post(
+            TELEGRAM_SEND_MESSAGE_URL,
+            json={**SEND_MESSAGE_DEFAULTS, "chat_id": chat_id, "text": text},
             timeout=10,
         )
         if resp.status_code != 200:
             print("Telegram error:", resp.text)
         resp.raise_for_status()
+        return True
     except Exception as e:
         print("send_message error:", e)
+        return False
 
 def send_sticker(chat_id: int, file_id: str) -> None:
     try:
-        resp = requests.post(
-            f"{TELEGRAM_API}/sendSticker",
+        resp = SESSION.post(
+            TELEGRAM_SEND_STICKER_URL,
             json={"chat_id": chat_id, "sticker": file_id},
             timeout=10,
         )
@@ -107,16 +251,26 @@ def send_sticker(chat_id: int, file_id: str) -> None:
     except Exception as e:
         print("send_sticker error:", e)
 
+# рассылка уведомлений идёт в фоне, чтобы вебхук GitLab сразу получал 200
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tg-send")
+MAX_PENDING_SENDS = 1000
+
+def _submit(fn, *args) -> None:
+    # не даём очереди расти бесконечно при всплеске вебхуков
+    if EXECUTOR._work_queue.qsize() >= MAX_PENDING_SENDS:
+        print(f"send queue is full, dropping {fn.__name__} for chat {args[0]}")
+        return
+    EXECUTOR.submit(fn, *args)
+
 # ================== КОМАНДЫ БОТА ==================
 
 def handle_start(chat_id: int) -> None:
-    user_lookup_url = f'{GITLAB_BASE_URL.rstrip("/")}/api/v4/users?username=USERNAME'
     send_message(
         chat_id,
         "Привет! 👋\n\n"
         "Чтобы получать уведомления о <b>аппрувах твоих Merge Request</b> в GitLab:\n\n"
         "1. Открой в браузере:\n"
-        f'<a href="{user_lookup_url}">{user_lookup_url}</a>\n'
+        f'<a href="{GITLAB_USER_LOOKUP_URL}">{GITLAB_USER_LOOKUP_URL}</a>\n'
         "2. В ответе найди поле <code>id</code> — это твой GitLab ID.\n"
         "3. Пришли мне это число одним сообщением, например:\n"
         "   <code>15499688</code>\n\n"
@@ -138,8 +292,7 @@ def handle_gitlab_id(chat_id: int, text: str) -> None:
         )
         return
 
-    subscriptions[str(chat_id)] = value
-    _save_json(SUBSCRIPTIONS_FILE, subscriptions)
+    _subscribe(chat_id, value)
 
     send_message(
         chat_id,
@@ -163,11 +316,23 @@ def handle_update(update: dict) -> None:
     else:
         handle_gitlab_id(chat_id, text)
 
+# long polling: Telegram держит запрос до 30 с и отдаёт только message-апдейты
+GET_UPDATES_TIMEOUT = 30
+GET_UPDATES_PARAMS: dict[str, object] = {
+    "timeout": GET_UPDATES_TIMEOUT,
+    "limit": 100,
+    "allowed_updates": orjson.dumps(["message"]).decode("utf-8"),
+}
+
 def get_updates(offset: Optional[int]) -> list[dict]:
-    params: dict[str, int] = {"timeout": 30}
+    params = GET_UPDATES_PARAMS
     if offset is not None:
-        params["offset"] = offset
-    resp = requests.get(f"{TELEGRAM_API}/getUpdates", params=params, timeout=35)
+        params = {**GET_UPDATES_PARAMS, "offset": offset}
+    resp = SESSION.get(
+        TELEGRAM_GET_UPDATES_URL,
+        params=params,
+        timeout=(5, GET_UPDATES_TIMEOUT + 5),  # (connect, read)
+    )
     resp.raise_for_status()
     data = resp.json()
     if not data.get("ok"):
@@ -175,6 +340,24 @@ def get_updates(offset: Optional[int]) -> list[dict]:
         return []
     return data.get("result", [])
 
+def set_telegram_webhook() -> None:
+    resp = SESSION.post(
+        f"{TELEGRAM_API}/setWebhook",
+        json={
+            "url": f"{TELEGRAM_WEBHOOK_URL}/telegram/webhook/{TELEGRAM_WEBHOOK_SECRET}",
+            "secret_token": TELEGRAM_WEBHOOK_SECRET,
+            "allowed_updates": ["message"],
+        },
+        timeout=10,
+    )
+    resp.raise_for_status()
+    print("Telegram webhook set:", resp.json().get("description"))
+
+def delete_telegram_webhook() -> None:
+    # getUpdates не работает, пока у бота висит вебхук
+    resp = SESSION.post(f"{TELEGRAM_API}/deleteWebhook", timeout=10)
+    resp.raise_for_status()
+
 # ================== GITLAB ВСПОМОГАТЕЛЬНОЕ ==================
 
 def _api_base_from_payload(payload: dict) -> str:
@@ -187,6 +370,41 @@ def _api_base_from_payload(payload: dict) -> str:
         pass
     return "https://gitlab.com/api/v4"
 
+# (project_id, iid, action, user_id) -> (expires_at, approved_count)
+# повторная доставка того же события (ретраи GitLab, хуки проекта + группы) не дёргает API ещё раз;
+# аппрув другого ревьюера — другой ключ, поэтому счётчик не устаревает
+APPROVALS_CACHE_TTL = 5.0
+# сколько вебхук ждёт ответа API, прежде чем взять счётчик из payload
+APPROVALS_API_WAIT = 5.0
+# свой пул для запросов к API: в общем пуле рассылки запрос встал бы в очередь за отправками в Telegram
+APPROVALS_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gitlab-api")
+APPROVALS_CACHE_ERROR_TTL = 1.0
+APPROVALS_CACHE_MAXSIZE = 1024
+_approvals_cache: dict[tuple, tuple[float, Optional[int]]] = {}
+_approvals_cache_lock = threading.Lock()
+
+def _approvals_cache_get(key: tuple) -> tuple[bool, Optional[int]]:
+    with _approvals_cache_lock:
+        entry = _approvals_cache.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del _approvals_cache[key]
+            return False, None
+        return True, value
+
+def _approvals_cache_put(key: tuple, value: Optional[int]) -> None:
+    ttl = APPROVALS_CACHE_TTL if value is not None else APPROVALS_CACHE_ERROR_TTL
+    now = time.monotonic()
+    with _approvals_cache_lock:
+        if len(_approvals_cache) >= APPROVALS_CACHE_MAXSIZE:
+            for k in [k for k, (exp, _) in _approvals_cache.items() if exp < now]:
+                del _approvals_cache[k]
+            if len(_approvals_cache) >= APPROVALS_CACHE_MAXSIZE:
+                _approvals_cache.clear()
+        _approvals_cache[key] = (now + ttl, value)
+
 def _approvals_via_api(payload: dict) -> Optional[int]:
     """Вернёт approved_count (len(approved_by)) или None при ошибке/отсутствии токена."""
     if not GITLAB_API_TOKEN:
@@ -198,52 +416,58 @@ def _approvals_via_api(payload: dict) -> Optional[int]:
     if not project_id or not iid:
         return None
 
+    cache_key = (project_id, iid, attrs.get("action"), (payload.get("user") or {}).get("id"))
+    hit, cached = _approvals_cache_get(cache_key)
+    if hit:
+        return cached
+
     api_base = _api_base_from_payload(payload)
     url = f"{api_base}/projects/{project_id}/merge_requests/{iid}/approvals"
 
-    headers = {}
-    if GITLAB_API_TOKEN_TYPE == "bearer":
-        headers["Authorization"] = f"Bearer {GITLAB_API_TOKEN}"
-    else:
-        headers["PRIVATE-TOKEN"] = GITLAB_API_TOKEN
-
+    approved_count: Optional[int] = None
     try:
-        r = requests.get(url, headers=headers, timeout=10)
+        r = GITLAB_SESSION.get(url, timeout=10)
         if r.status_code != 200:
             print("approvals API error:", r.status_code, r.text)
-            return None
-        data = r.json()
-        approved_by = data.get("approved_by") or []
-        return len(approved_by)
+        else:
+            data = r.json()
+            approved_by = data.get("approved_by") or []
+            approved_count = len(approved_by)
     except Exception as e:
         print("approvals API exception:", e)
-        return None
+
+    _approvals_cache_put(cache_key, approved_count)
+    return approved_count
+
+def _dispatch(chat_id: int, text: str, sticker_file_id: str) -> None:
+    # стикер идёт строго после текста, поэтому запросы не параллелим;
+    # если текст не доставлен (бот заблокирован, чат удалён) — второй запрос не делаем
+    if send_message(chat_id, text):
+        send_sticker(chat_id, sticker_file_id)
 
 def find_chats_for_author(author_id: int) -> list[int]:
-    result: list[int] = []
-    for chat_id_str, gitlab_id in subscriptions.items():
-        try:
-            gitlab_id_int = int(gitlab_id)
-        except Exception:
-            continue
-        if gitlab_id_int == author_id:
-            try:
-                result.append(int(chat_id_str))
-            except Exception:
-                continue
-    return result
+    try:
+        rows = _db().execute("SELECT chat_id FROM subs WHERE gitlab_id = ?", (author_id,)).fetchall()
+    except Exception as e:
+        print(f"load error for {SUBSCRIPTIONS_DB_FILE.name}:", e)
+        return []
+    return [chat_id for (chat_id,) in rows]
 
+# проекты, авторы и ветки повторяются из вебхука в вебхук;
+# markupsafe (C-расширение, ставится вместе с Flask) экранирует ещё и кавычки — Telegram их понимает
+@functools.lru_cache(maxsize=4096)
 def _escape_html(text: str) -> str:
-    return (text or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return str(escape(text or ""))
 
+# проект + ветка (main, develop, ...) повторяются, quote() на чистом Python — кэшируем готовую ссылку
+@functools.lru_cache(maxsize=2048)
 def _branch_url(project_web_url: str, branch: str) -> Optional[str]:
     if not project_web_url or not branch:
         return None
     return f"{project_web_url.rstrip('/')}/-/tree/{quote(branch, safe='')}"
 
-def _current_reviewer_ids(payload: dict) -> Set[int]:
+def _current_reviewer_ids(attrs: dict, reviewers: list) -> Set[int]:
     ids: Set[int] = set()
-    attrs = payload.get("object_attributes") or {}
 
     for rid in (attrs.get("reviewer_ids") or []):
         try:
@@ -251,31 +475,40 @@ def _current_reviewer_ids(payload: dict) -> Set[int]:
         except Exception:
             pass
 
-    if isinstance(payload.get("reviewers"), list):
-        for r in payload["reviewers"]:
-            try:
-                rid = r.get("id")
-                if rid is not None:
-                    ids.add(int(rid))
-            except Exception:
-                pass
+    for r in reviewers:
+        try:
+            rid = r.get("id")
+            if rid is not None:
+                ids.add(int(rid))
+        except Exception:
+            pass
     return ids
 
 # ================== ВЕБХУК ==================
 
+def _secret_matches(value: Optional[str], expected: str) -> bool:
+    # сравнение за постоянное время, чтобы по таймингу нельзя было подобрать секрет
+    return hmac.compare_digest((value or "").encode("utf-8"), expected.encode("utf-8"))
+
 @app.post("/gitlab/webhook")
 def gitlab_webhook():
     # проверяем секрет, если задан
     if GITLAB_WEBHOOK_SECRET:
         token = request.headers.get("X-Gitlab-Token")
-        if token != GITLAB_WEBHOOK_SECRET:
+        if not _secret_matches(token, GITLAB_WEBHOOK_SECRET):
             return "forbidden", 403
 
     payload = request.get_json(silent=True) or {}
     if payload.get("object_kind") != "merge_request":
         return "", 200
 
+    # разбираем вложенные объекты один раз, дальше работаем с готовыми dict/list
     attrs = payload.get("object_attributes") or {}
+    project = payload.get("project") or {}
+    user = payload.get("user") or {}
+    reviewers = payload.get("reviewers")
+    if not isinstance(reviewers, list):
+        reviewers = []
     action = (attrs.get("action") or "").lower()
 
     author_id = attrs.get("author_id")
@@ -284,18 +517,37 @@ def gitlab_webhook():
     except Exception:
         author_id_int = None
 
-    project_ns_path = (payload.get("project") or {}).get("path_with_namespace", "unknown")
-    project_web_url = (payload.get("project") or {}).get("web_url") or ""
+    # ===== аппрувы: подписчиков и счётчик узнаём сразу, чтобы запрос к API шёл параллельно со сборкой текста =====
+    is_approval_event = action in ("approved", "unapproved", "unapproval")
+    approvals_future = None
+    if is_approval_event:
+        if author_id_int is None:
+            return "", 200
+
+        chats = find_chats_for_author(author_id_int)
+        if not chats:
+            return "", 200
+
+        total_reviewers = len(reviewers)
+        approved = [r for r in reviewers if r.get("state") == "approved"]
+        approved_count = len(approved)
+        approved_ids = {r.get("id") for r in approved}
+        # payload не сходится с событием, если аппрувера нет среди одобривших ревьюеров
+        # (он не в списке ревьюеров или данные отстали) — тогда спрашиваем API
+        if GITLAB_API_TOKEN and (
+            GITLAB_APPROVALS_API == "always"
+            or (action == "approved" and user.get("id") not in approved_ids)
+        ):
+            approvals_future = APPROVALS_EXECUTOR.submit(_approvals_via_api, payload)
+
+    project_ns_path = project.get("path_with_namespace", "unknown")
+    project_web_url = project.get("web_url") or ""
     mr_title = _escape_html(attrs.get("title") or "")
     iid = attrs.get("iid") or attrs.get("id") or "?"
     mr_url = attrs.get("url") or attrs.get("web_url") or ""
     source_branch = attrs.get("source_branch") or ""
     target_branch = attrs.get("target_branch") or ""
-    actor = _escape_html(
-        (payload.get("user") or {}).get("name")
-        or (payload.get("user") or {}).get("username")
-        or "кто-то"
-    )
+    actor = _escape_html(user.get("name") or user.get("username") or "кто-то")
 
     # ссылки/линии
     project_link = (
@@ -314,23 +566,15 @@ def gitlab_webhook():
     )
 
     # ===== 1) APPROVED / UNAPPROVED =====
-    if action in ("approved", "unapproved", "unapproval"):
-        if author_id_int is None:
-            return "", 200
-
-        chats = find_chats_for_author(author_id_int)
-        if not chats:
-            return "", 200
-
-        reviewers = payload.get("reviewers") or []
-        total_reviewers = len(reviewers) if isinstance(reviewers, list) else 0
-
-        approved_count = _approvals_via_api(payload)
-        if approved_count is None:
-            approved_count = (
-                sum(1 for r in reviewers if r.get("state") == "approved")
-                if isinstance(reviewers, list) else 0
-            )
+    if is_approval_event:
+        if approvals_future is not None:
+            try:
+                api_count = approvals_future.result(timeout=APPROVALS_API_WAIT)
+            except Exception as e:
+                print("approvals API wait error:", repr(e))
+                api_count = None
+            if api_count is not None:
+                approved_count = api_count
         count_text = f"{approved_count} из {total_reviewers}" if total_reviewers > 0 else str(approved_count)
 
         if action == "approved":
@@ -346,22 +590,22 @@ def gitlab_webhook():
             f"<b>Аппрувер:</b> {actor}\n"
         )
 
+        # текст и стикер не зависят от чата — выбираем один раз на всю рассылку
+        if action != "approved":
+            sticker_file_id = STICKER_UNAPPROVAL
+        elif total_reviewers > 0 and approved_count >= total_reviewers:
+            text += "\n<b>Можно мержить!</b>"
+            sticker_file_id = STICKER_MERGE_OK
+        else:
+            sticker_file_id = STICKER_APPROVED
+
         for chat_id in chats:
-            if action == "approved":
-                if total_reviewers > 0 and approved_count >= total_reviewers:
-                    send_message(chat_id, text + "\n<b>Можно мержить!</b>")
-                    send_sticker(chat_id, STICKER_MERGE_OK)
-                else:
-                    send_message(chat_id, text)
-                    send_sticker(chat_id, STICKER_APPROVED)
-            else:
-                send_message(chat_id, text)
-                send_sticker(chat_id, STICKER_UNAPPROVAL)
+            _submit(_dispatch, chat_id, text, sticker_file_id)
 
         return "", 200
 
     # ===== 2) НАЗНАЧЕНИЕ/СНЯТИЕ РЕВЬЮЕРОВ (с дедупликацией) =====
-    project_id = attrs.get("target_project_id") or (payload.get("project") or {}).get("id")
+    project_id = attrs.get("target_project_id") or project.get("id")
     if not project_id or not iid:
         return "", 200
 
@@ -371,19 +615,20 @@ def gitlab_webhook():
     except Exception:
         return "", 200
 
-    current_ids = _current_reviewer_ids(payload)
-    prev_ids = _get_prev_reviewer_set(project_id_int, iid_int)
+    current_ids = _current_reviewer_ids(attrs, reviewers)
+    with _mr_reviewers_lock:
+        prev_ids = _get_prev_reviewer_set(project_id_int, iid_int)
 
-    # если бот впервые видит НЕ open-событие по MR — считаем, что прежнее состояние = текущее (чтобы не было ложного "назначили")
-    is_first_seen = (_mr_key(project_id_int, iid_int) not in _mr_reviewers_store)
-    if is_first_seen and action != "open":
-        prev_ids = current_ids
+        # если бот впервые видит НЕ open-событие по MR — считаем, что прежнее состояние = текущее (чтобы не было ложного "назначили")
+        is_first_seen = (_mr_key(project_id_int, iid_int) not in _mr_reviewers_store)
+        if is_first_seen and action != "open":
+            prev_ids = current_ids
 
-    added_ids = current_ids - prev_ids
-    removed_ids = prev_ids - current_ids
+        added_ids = current_ids - prev_ids
+        removed_ids = prev_ids - current_ids
 
-    # обновляем состояние перед отправкой (чтобы при падении/рестарте не было дребезга)
-    _set_current_reviewer_set(project_id_int, iid_int, current_ids)
+        # обновляем состояние перед отправкой (чтобы при падении/рестарте не было дребезга)
+        _set_current_reviewer_set(project_id_int, iid_int, current_ids)
 
     # уведомляем о назначении
     if added_ids:
@@ -399,7 +644,7 @@ def gitlab_webhook():
                 f"<b>Назначил(а):</b> {actor}\n"
             )
             for chat_id in chats:
-                send_message(chat_id, text)
+                _submit(send_message, chat_id, text)
 
     # уведомляем о снятии
     if removed_ids:
@@ -415,11 +660,30 @@ def gitlab_webhook():
                 f"<b>Инициатор:</b> {actor}\n"
             )
             for chat_id in chats:
-                send_message(chat_id, text)
+                _submit(send_message, chat_id, text)
 
     # если состав не изменился — ничего не шлём
     return "", 200
 
+@app.post("/telegram/webhook/<secret>")
+def telegram_webhook(secret: str):
+    # в режиме polling эндпоинта нет, даже если секрет задан
+    if not TELEGRAM_WEBHOOK_URL or not TELEGRAM_WEBHOOK_SECRET:
+        return "not found", 404
+    header_token = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+    if not (
+        _secret_matches(secret, TELEGRAM_WEBHOOK_SECRET)
+        and _secret_matches(header_token, TELEGRAM_WEBHOOK_SECRET)
+    ):
+        return "forbidden", 403
+
+    update = request.get_json(silent=True) or {}
+    try:
+        handle_update(update)
+    except Exception as e:
+        print("Error in telegram webhook:", e)
+    return "", 200
+
 # ================== RUNNERS ==================
 
 def telegram_poller():
@@ -442,12 +706,34 @@ def run_flask():
     print(f"Flask server starting on 0.0.0.0:{FLASK_PORT} ...")
     app.run(host="0.0.0.0", port=FLASK_PORT)
 
-def main():
-    # поднимаем Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    # запускаем long polling
+def _retry_until_ok(fn) -> None:
+    # как и в цикле поллера: сетевые сбои и 5xx на старте не должны ронять процесс,
+    # а 4xx (неверный URL/секрет/токен) повтором не лечится — пробрасываем
+    while True:
+        try:
+            fn()
+            return
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"Error in {fn.__name__}:", e)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code < 500:
+                raise
+            print(f"Error in {fn.__name__}:", e)
+        time.sleep(5)
+
+def run_telegram():
+    # отдельный процесс (python poller.py): вебхуки GitLab обслуживает gunicorn wsgi:app
+    if TELEGRAM_WEBHOOK_URL:
+        # апдейты приходят в Flask на /telegram/webhook/<secret>, достаточно зарегистрировать вебхук
+        _retry_until_ok(set_telegram_webhook)
+        return
+    _retry_until_ok(delete_telegram_webhook)
     telegram_poller()
 
+def main():
+    # локальный запуск вебхук-сервера; Telegram — отдельным процессом через poller.py
+    prewarm_connections()
+    run_flask()
+
 if __name__ == "__main__":
     main()
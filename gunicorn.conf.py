@@ -0,0 +1,15 @@
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '3000')}"
+
+# состав ревьюеров MR живёт в памяти процесса (mr_reviewers.json) — один воркер, параллелизм потоками
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = 30
+keepalive = 5
+
+def post_worker_init(worker):
+    # пул соединений у каждого воркера свой, прогреваем уже после fork
+    from app import prewarm_connections
+    prewarm_connections()
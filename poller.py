@@ -0,0 +1,7 @@
+# точка входа для Telegram-части бота, запускается отдельно от веб-процесса:
+#   python poller.py        — long polling (или регистрация вебхука при TELEGRAM_WEBHOOK_URL)
+#   gunicorn wsgi:app       — вебхуки GitLab (и Telegram в режиме вебхука)
+from app import run_telegram
+
+if __name__ == "__main__":
+    run_telegram()
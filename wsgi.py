@@ -0,0 +1,5 @@
+# точка входа для WSGI-сервера:
+#   gunicorn wsgi:app   (настройки в gunicorn.conf.py)
+from app import app
+
+__all__ = ["app"]